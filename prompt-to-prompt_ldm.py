@@ -19,12 +19,28 @@ import seq_aligner
 
 # %%
 device = torch.device('cuda:0') if torch.cuda.is_available() else torch.device('cpu')
+# TF32 matmuls/convolutions on Ampere and newer GPUs, no effect elsewhere
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
 model_id = "CompVis/ldm-text2im-large-256"
 NUM_DIFFUSION_STEPS = 50
 GUIDANCE_SCALE = 5.
 MAX_NUM_WORDS = 77
+# compile the UNet with torch.compile (torch >= 2.0), pays off when generating many images in one session
+COMPILE_UNET = False
+# compile the LocalBlend mask computation with torch.compile (torch >= 2.0), off by default: it needs a working
+# inductor toolchain and every new process pays the compilation for about ten small ops per step
+COMPILE_BLEND = False
+# attention maps with at most this many pixels (16x16) are kept by AttentionStore
+MAX_STORE_PIXELS = 256
+STORE_KEYS = {(place_in_unet, is_cross): f"{place_in_unet}_{'cross' if is_cross else 'self'}"
+              for place_in_unet in ("down", "mid", "up") for is_cross in (True, False)}
 # load model and scheduler
 ldm = DiffusionPipeline.from_pretrained(model_id).to(device)
+if COMPILE_UNET and hasattr(torch, "compile"):
+    # compile forward rather than the module so register_attention_control still finds the attention layers.
+    # no CUDA graphs: the controllers keep references to attention tensors across layers and steps
+    ldm.unet.forward = torch.compile(ldm.unet.forward, fullgraph=False)
 tokenizer = ldm.tokenizer
 
 # ## Prompt-to-Prompt Attnetion Controllers
@@ -35,32 +51,57 @@ tokenizer = ldm.tokenizer
 # 
 
 # %%
+def maybe_compile(enabled: bool, **compile_kwargs):
+    # torch.compile only exists from torch 2.0 on, older versions simply run eagerly
+    def decorator(func):
+        if enabled and hasattr(torch, "compile"):
+            return torch.compile(func, **compile_kwargs)
+        return func
+    return decorator
+
+
+@maybe_compile(COMPILE_BLEND, fullgraph=False, dynamic=False)
+def _blend_impl(x_t, maps, alpha_layers, threshold: float, mask, k: int = 1):
+    # maps are groups of stacked (layers, batch, heads, 1, 16, 16, words) maps, averaged over all layers and heads.
+    # mask is a persistent (batch, 1, *x_t.shape[2:]) float buffer the thresholded mask is written into
+    num_maps = sum(item.shape[0] * item.shape[2] for item in maps)
+    maps = sum((item * alpha_layers).sum(-1).sum((0, 2)) for item in maps) / num_maps
+    maps = nnf.max_pool2d(maps, (k * 2 + 1, k * 2 +1), (1, 1), padding=(k, k))
+    maps = nnf.interpolate(maps, size=(x_t.shape[2:]))
+    maps.div_(maps.amax(dim=(2, 3), keepdim=True).clamp_min(1e-8))
+    torch.gt(maps, threshold, out=mask)
+    torch.maximum(mask[1:], mask[:1], out=mask[1:])
+    # x_t[:1] + mask * (x_t - x_t[:1])
+    return torch.lerp(x_t[:1], x_t, mask)
+
+
 class LocalBlend:
 
-    def __call__(self, x_t, attention_store, step):
-        k = 1
-        maps = attention_store["down_cross"][:2] + attention_store["up_cross"][3:6]
-        maps = [item.reshape(self.alpha_layers.shape[0], -1, 1, 16, 16, MAX_NUM_WORDS) for item in maps]
-        maps = torch.cat(maps, dim=1)
-        maps = (maps * self.alpha_layers).sum(-1).mean(1)
-        mask = nnf.max_pool2d(maps, (k * 2 + 1, k * 2 +1), (1, 1), padding=(k, k))
-        mask = nnf.interpolate(maps, size=(x_t.shape[2:]))
-        mask = mask / mask.max(2, keepdims=True)[0].max(3, keepdims=True)[0]
-        mask = mask.gt(self.threshold)
-        mask = (mask[:1] + mask).float()
-        x_t = x_t[:1] + mask * (x_t - x_t[:1])
-        return x_t
+    def __call__(self, x_t, controller, step):
+        # controller is the AttentionStore itself, its packed buffers are read as stacked views
+        maps = controller.get_stacked_maps("down_cross", 0, 2), controller.get_stacked_maps("up_cross", 3, 6)
+        maps = [item.view(item.shape[0], self.alpha_layers.shape[0], -1, 1, 16, 16, MAX_NUM_WORDS) for item in maps]
+        mask_shape = (x_t.shape[0], 1, *x_t.shape[2:])
+        # a buffer allocated under inference_mode cannot be written outside of it (and vice versa for autograd)
+        if self.mask is None or self.mask.shape != mask_shape \
+                or self.mask.is_inference() != torch.is_inference_mode_enabled():
+            self.mask = torch.empty(mask_shape, dtype=x_t.dtype, device=x_t.device)
+        return _blend_impl(x_t, maps, self.alpha_layers, self.threshold, self.mask)
        
     def __init__(self, prompts: List[str], words: [List[List[str]]], threshold: float = .3):
         alpha_layers = torch.zeros(len(prompts),  1, 1, 1, 1, MAX_NUM_WORDS)
+        rows, cols = [], []
         for i, (prompt, words_) in enumerate(zip(prompts, words)):
             if type(words_) is str:
                 words_ = [words_]
             for word in words_:
-                ind = ptp_utils.get_word_inds(prompt, word, tokenizer)
-                alpha_layers[i, :, :, :, :, ind] = 1
+                ind = ptp_utils.get_word_inds(prompt, word, tokenizer).tolist()
+                rows += [i] * len(ind)
+                cols += ind
+        alpha_layers[torch.as_tensor(rows, dtype=torch.long), 0, 0, 0, 0, torch.as_tensor(cols, dtype=torch.long)] = 1
         self.alpha_layers = alpha_layers.to(device)
         self.threshold = threshold
+        self.mask = None
 
 
 class AttentionControl(abc.ABC):
@@ -75,14 +116,21 @@ class AttentionControl(abc.ABC):
     def forward (self, attn, is_cross: bool, place_in_unet: str):
         raise NotImplementedError
 
-    def __call__(self, attn, is_cross: bool, place_in_unet: str):
-        h = attn.shape[0]
-        attn[h // 2:] = self.forward(attn[h // 2:], is_cross, place_in_unet)
+    def needs_weights(self, is_cross: bool, place_in_unet: str, num_pixels: int):
+        # layers for which this returns False run fused attention and only advance the layer counter
+        return True
+
+    def next_layer(self):
         self.cur_att_layer += 1
         if self.cur_att_layer == self.num_att_layers:
             self.cur_att_layer = 0
             self.cur_step += 1
             self.between_steps()
+
+    def __call__(self, attn, is_cross: bool, place_in_unet: str):
+        h = attn.shape[0]
+        attn[h // 2:] = self.forward(attn[h // 2:], is_cross, place_in_unet)
+        self.next_layer()
         return attn
     
     def reset(self):
@@ -96,6 +144,9 @@ class AttentionControl(abc.ABC):
 
 
 class EmptyControl(AttentionControl):
+
+    def needs_weights(self, is_cross: bool, place_in_unet: str, num_pixels: int):
+        return False
     
     def forward (self, attn, is_cross: bool, place_in_unet: str):
         return attn
@@ -108,26 +159,53 @@ class AttentionStore(AttentionControl):
         return {"down_cross": [], "mid_cross": [], "up_cross": [],
                 "down_self": [],  "mid_self": [],  "up_self": []}
 
+    def needs_weights(self, is_cross: bool, place_in_unet: str, num_pixels: int):
+        return num_pixels <= MAX_STORE_PIXELS
+
     def forward(self, attn, is_cross: bool, place_in_unet: str):
-        if attn.shape[1] <= 16 ** 2:  # avoid memory overhead
-            key = f"{place_in_unet}_{'cross' if is_cross else 'self'}"
-            self.step_store[key].append(attn)
+        if attn.shape[1] <= MAX_STORE_PIXELS:  # avoid memory overhead
+            key = STORE_KEYS[(place_in_unet, is_cross)]
+            # keep the stored maps in half precision, they are only summed and read back for blending/visualization
+            self.step_store[key].append(attn.to(torch.float16))
         return attn
 
     # Q3 Abel: what is the purpose of this function?
     def between_steps(self):
         if len(self.attention_store) == 0:
-            self.attention_store = self.step_store
+            for key in self.step_store:
+                self.pack_store(key, self.step_store[key])
         else:
             for key in self.attention_store:
-                for i in range(len(self.attention_store[key])):
-                    self.attention_store[key][i] += self.step_store[key][i]
+                if len(self.attention_store[key]) > 0:
+                    # one multi-tensor kernel per key instead of one add per stored map
+                    torch._foreach_add_(self.attention_store[key], self.step_store[key])
         self.step_store = self.get_empty_store()
+        self.average_cache, self.average_cache_step = None, -1
+
+    def pack_store(self, key, maps):
+        # lay the maps of a key out back to back in one buffer, the stored items are views into it
+        offsets = [0]
+        for item in maps:
+            offsets.append(offsets[-1] + item.numel())
+        buffer = torch.cat([item.reshape(-1) for item in maps]) if len(maps) > 0 else None
+        self.attention_store[key] = [buffer[offsets[i]: offsets[i + 1]].view(item.shape) for i, item in enumerate(maps)]
+        self.store_buffers[key] = buffer, offsets
+
+    def get_stacked_maps(self, key, start, stop):
+        # (stop - start, *map_shape) view over consecutive stored maps of the same shape, no copy
+        buffer, offsets = self.store_buffers[key]
+        return buffer[offsets[start]: offsets[stop]].view(stop - start, *self.attention_store[key][start].shape)
 
     def get_average_attention(self):
         # Q2 Abel: average over what?
         # 
-        average_attention = {key: [item / self.cur_step for item in self.attention_store[key]] for key in self.attention_store}
+        if self.average_cache_step == self.cur_step:
+            return self.average_cache
+        average_attention = {key: [item.float() for item in self.attention_store[key]] for key in self.attention_store}
+        for key in average_attention:
+            if len(average_attention[key]) > 0:
+                torch._foreach_mul_(average_attention[key], 1. / self.cur_step)
+        self.average_cache, self.average_cache_step = average_attention, self.cur_step
         return average_attention
 
 
@@ -135,44 +213,66 @@ class AttentionStore(AttentionControl):
         super(AttentionStore, self).reset()
         self.step_store = self.get_empty_store()
         self.attention_store = {}
+        self.store_buffers = {}
+        self.average_cache, self.average_cache_step = None, -1
 
     def __init__(self):
         super(AttentionStore, self).__init__()
         self.step_store = self.get_empty_store()
         self.attention_store = {}
+        self.store_buffers = {}
+        self.average_cache, self.average_cache_step = None, -1
 
         
 class AttentionControlEdit(AttentionStore, abc.ABC):
     
     def step_callback(self, x_t):
         if self.local_blend is not None:
-            x_t = self.local_blend(x_t, self.attention_store, self.cur_step)
+            x_t = self.local_blend(x_t, controller=self, step=self.cur_step)
         return x_t
         
     def replace_self_attention(self, attn_base, att_replace):
         if att_replace.shape[2] <= 16 ** 2:
-            return attn_base.unsqueeze(0).expand(att_replace.shape[0], *attn_base.shape)
+            return attn_base.unsqueeze(0).expand_as(att_replace)
         else:
             return att_replace
     
     @abc.abstractmethod
     def replace_cross_attention(self, attn_base, att_replace):
         raise NotImplementedError
+
+    def needs_weights(self, is_cross: bool, place_in_unet: str, num_pixels: int):
+        # cross attention is edited at every resolution, self attention is only replaced on the stored resolutions
+        return is_cross or super(AttentionControlEdit, self).needs_weights(is_cross, place_in_unet, num_pixels)
     
     def forward(self, attn, is_cross: bool, place_in_unet: str):
-        super(AttentionControlEdit, self).forward(attn, is_cross, place_in_unet)
         if is_cross or (self.num_self_replace[0] <= self.cur_step < self.num_self_replace[1]):
+            # edit through a view so the result lands in attn's own storage, no reshape back needed
+            attn = attn.contiguous()
             h = attn.shape[0] // (self.batch_size)
-            attn = attn.reshape(self.batch_size, h, *attn.shape[1:])
-            attn_base, attn_repalce = attn[0], attn[1:]
+            attn_view = attn.view(self.batch_size, h, *attn.shape[1:])
+            attn_base, attn_repalce = attn_view[0], attn_view[1:]
             if is_cross:
-                alpha_words = self.cross_replace_alpha[self.cur_step]
-                attn_repalce_new = self.replace_cross_attention(attn_base, attn_repalce) * alpha_words + (1 - alpha_words) * attn_repalce
-                attn[1:] = attn_repalce_new
+                # lerp(a, b, w) == b * w + (1 - w) * a in a single kernel
+                attn_repalce_new = torch.lerp(attn_repalce, self.replace_cross_attention(attn_base, attn_repalce), self.cur_alpha_words)
+                # slice assignment rather than copy_: a composed AttentionReweight returns an extra leading singleton dim
+                attn_view[1:] = attn_repalce_new
             else:
-                attn[1:] = self.replace_self_attention(attn_base, attn_repalce)
-            attn = attn.reshape(self.batch_size * h, *attn.shape[2:])
+                # copy_ broadcasts the expanded base directly, and large maps that come back untouched are not copied at all
+                attn_repalce_new = self.replace_self_attention(attn_base, attn_repalce)
+                if attn_repalce_new is not attn_repalce:
+                    attn_repalce.copy_(attn_repalce_new)
+        # stored after editing: the half precision copy no longer aliases attn, so in-place edits would not reach it
+        super(AttentionControlEdit, self).forward(attn, is_cross, place_in_unet)
         return attn
+
+    def between_steps(self):
+        super(AttentionControlEdit, self).between_steps()
+        self.cur_alpha_words = self.cross_replace_alpha[self.cur_step]
+
+    def reset(self):
+        super(AttentionControlEdit, self).reset()
+        self.cur_alpha_words = self.cross_replace_alpha[self.cur_step]
     
     def __init__(self, prompts, num_steps: int,
                  cross_replace_steps: Union[float, Tuple[float, float], Dict[str, Tuple[float, float]]],
@@ -181,6 +281,7 @@ class AttentionControlEdit(AttentionStore, abc.ABC):
         super(AttentionControlEdit, self).__init__()
         self.batch_size = len(prompts)
         self.cross_replace_alpha = ptp_utils.get_time_words_attention_alpha(prompts, num_steps, cross_replace_steps, tokenizer).to(device)
+        self.cur_alpha_words = self.cross_replace_alpha[self.cur_step]
         if type(self_replace_steps) is float:
             self_replace_steps = 0, self_replace_steps
         self.num_self_replace = int(num_steps * self_replace_steps[0]), int(num_steps * self_replace_steps[1])
@@ -189,7 +290,8 @@ class AttentionControlEdit(AttentionStore, abc.ABC):
 class AttentionReplace(AttentionControlEdit):
 
     def replace_cross_attention(self, attn_base, att_replace):
-        return torch.einsum('hpw,bwn->bhpn', attn_base, self.mapper)
+        # (1, h, p, w) @ (b, 1, w, n) -> (b, h, p, n), same as einsum('hpw,bwn->bhpn') as one batched gemm
+        return torch.matmul(attn_base.unsqueeze(0), self.mapper.unsqueeze(1))
       
     def __init__(self, prompts, num_steps: int, cross_replace_steps: float, self_replace_steps: float,
                  local_blend: Optional[LocalBlend] = None):
@@ -200,7 +302,9 @@ class AttentionReplace(AttentionControlEdit):
 class AttentionRefine(AttentionControlEdit):
 
     def replace_cross_attention(self, attn_base, att_replace):
-        attn_base_replace = attn_base[:, :, self.mapper].permute(2, 0, 1, 3)
+        # out[b, h, p, n] = attn_base[h, p, mapper[b, n]], gathered straight into the (b, h, p, n) layout
+        index = self.mapper_index.expand(-1, *attn_base.shape[:2], -1)
+        attn_base_replace = torch.gather(attn_base.unsqueeze(0).expand(self.mapper.shape[0], -1, -1, -1), 3, index)
         attn_replace = attn_base_replace * self.alphas + att_replace * (1 - self.alphas)
         return attn_replace
 
@@ -209,6 +313,7 @@ class AttentionRefine(AttentionControlEdit):
         super(AttentionRefine, self).__init__(prompts, num_steps, cross_replace_steps, self_replace_steps, local_blend)
         self.mapper, alphas = seq_aligner.get_refinement_mapper(prompts, tokenizer)
         self.mapper, alphas = self.mapper.to(device), alphas.to(device)
+        self.mapper_index = self.mapper.reshape(self.mapper.shape[0], 1, 1, self.mapper.shape[1])
         self.alphas = alphas.reshape(alphas.shape[0], 1, 1, alphas.shape[1])
 
 
@@ -233,10 +338,11 @@ def get_equalizer(text: str, word_select: Union[int, Tuple[int, ...]], values: U
         word_select = (word_select,)
     equalizer = torch.ones(len(values), 77)
     values = torch.tensor(values, dtype=torch.float32)
+    inds = []
     for word in word_select:
-        inds = ptp_utils.get_word_inds(text, word, tokenizer)
-        for i in inds:
-            equalizer[:, i] = values
+        inds += ptp_utils.get_word_inds(text, word, tokenizer).tolist()
+    inds = torch.as_tensor(inds, dtype=torch.long)
+    equalizer.index_copy_(1, inds, values.unsqueeze(-1).expand(len(values), len(inds)))
     return equalizer
 
 
@@ -244,7 +350,6 @@ def get_equalizer(text: str, word_select: Union[int, Tuple[int, ...]], values: U
 def aggregate_attention(attention_store: AttentionStore, res: int, from_where: List[str], is_cross: bool, select: int):
     out = []
     attention_maps = attention_store.get_average_attention()
-    print("attention_maps", attention_maps)
     num_pixels = res ** 2
     for location in from_where:
         for item in attention_maps[f"{location}_{'cross' if is_cross else 'self'}"]: 
@@ -253,7 +358,7 @@ def aggregate_attention(attention_store: AttentionStore, res: int, from_where: L
                 out.append(cross_maps)
     out = torch.cat(out, dim=0)
     out = out.sum(0) / out.shape[0]
-    return out.cpu()
+    return out
 
 
 def show_cross_attention(path_save, attention_store: AttentionStore, res: int, from_where: List[str], select: int = 0):
@@ -264,22 +369,22 @@ def show_cross_attention(path_save, attention_store: AttentionStore, res: int, f
 
     print("Before aggregate_attention, len(attention_store.get_average_attention()): ", len(attention_store.get_average_attention()))
     attention_maps = aggregate_attention(attention_store, res, from_where, True, select) # setting is_cross = True
-    images = []
-    for i in range(len(tokens)):
-        image = attention_maps[:, :, i]
-        image = 255 * image / image.max()
-        image = image.unsqueeze(-1).expand(*image.shape, 3)
-        image = image.numpy().astype(np.uint8)
-        image = np.array(Image.fromarray(image).resize((256, 256)))
-        image = ptp_utils.text_under_image(image, decoder(int(tokens[i])))
-        images.append(image)
+    # normalize and upsample all token maps in one batch, only the captions are drawn per token
+    maps = attention_maps[:, :, :len(tokens)].permute(2, 0, 1)
+    maps = 255 * maps / maps.amax(dim=(1, 2), keepdim=True)
+    maps = nnf.interpolate(maps.unsqueeze(1), size=(256, 256), mode="bicubic", align_corners=False)
+    maps = maps.clamp(0, 255).to(torch.uint8).expand(-1, 3, -1, -1).permute(0, 2, 3, 1).cpu().numpy()
+    images = [ptp_utils.text_under_image(image, decoder(int(tokens[i]))) for i, image in enumerate(maps)]
     ptp_utils.view_images(path_save, np.stack(images, axis=0))
     
 
 def show_self_attention_comp(path_save, attention_store: AttentionStore, res: int, from_where: List[str],
                         max_com=10, select: int = 0):
-    attention_maps = aggregate_attention(attention_store, res, from_where, False, select).numpy().reshape((res ** 2, res ** 2))
-    u, s, vh = np.linalg.svd(attention_maps - np.mean(attention_maps, axis=1, keepdims=True))
+    attention_maps = aggregate_attention(attention_store, res, from_where, False, select).reshape((res ** 2, res ** 2))
+    # only the leading max_com components are shown, a randomized low rank svd on the maps' device is enough
+    centered = attention_maps - attention_maps.mean(dim=1, keepdim=True)
+    _, _, v = torch.svd_lowrank(centered, q=max_com + 6, niter=2)
+    vh = v[:, :max_com].T.cpu().numpy()
     images = []
     for i in range(max_com):
         image = vh[i].reshape(res, res)
@@ -315,15 +420,16 @@ def sort_by_eq(eq):
 
 
 def run_and_display(path_save, prompts, controller, latent=None, run_baseline=True, callback:Optional[Callable[[np.ndarray], np.ndarray]] = None, generator=None):
-    if run_baseline:
-        print("w.o. prompt-to-prompt")
-        # run an extra round to get the baseline (no prompt-to-prompt)
-        images, latent = run_and_display(prompts, EmptyControl(), latent=latent, run_baseline=False)
-        print("results with prompt-to-prompt")
-    images, x_t = ptp_utils.text2image_ldm(ldm, prompts, controller, latent=latent, num_inference_steps=NUM_DIFFUSION_STEPS, guidance_scale=GUIDANCE_SCALE, generator=generator)
-    if callback is not None:
-        images = callback(images)
-    ptp_utils.view_images(path_save, images)
+    with torch.inference_mode():
+        if run_baseline:
+            print("w.o. prompt-to-prompt")
+            # run an extra round to get the baseline (no prompt-to-prompt)
+            images, latent = run_and_display(prompts, EmptyControl(), latent=latent, run_baseline=False)
+            print("results with prompt-to-prompt")
+        images, x_t = ptp_utils.text2image_ldm(ldm, prompts, controller, latent=latent, num_inference_steps=NUM_DIFFUSION_STEPS, guidance_scale=GUIDANCE_SCALE, generator=generator, compiled_unet=COMPILE_UNET)
+        if callback is not None:
+            images = callback(images)
+        ptp_utils.view_images(path_save, images)
     return images, x_t
 
 if __name__ == "__main__":
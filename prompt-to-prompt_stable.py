@@ -26,6 +26,7 @@ from diffusers import StableDiffusionPipeline
 import torch.nn.functional as nnf
 import numpy as np
 import abc
+from functools import lru_cache
 import ptp_utils
 import seq_aligner
 
@@ -39,6 +40,9 @@ LOW_RESOURCE = False
 NUM_DIFFUSION_STEPS = 50
 GUIDANCE_SCALE = 7.5
 MAX_NUM_WORDS = 77
+# compile AttentionRefine's gather and blend with torch.compile (torch >= 2.0), off by default: it needs a working
+# inductor toolchain and compiles once per attention resolution in every new process
+COMPILE_BLEND = False
 device = torch.device('cuda:0') if torch.cuda.is_available() else torch.device('cpu')
 # ldm_stable = StableDiffusionPipeline.from_pretrained("CompVis/stable-diffusion-v1-4", use_auth_token=MY_TOKEN).to(device)
 ldm_stable = StableDiffusionPipeline.from_pretrained("CompVis/stable-diffusion-v1-4").to(device)
@@ -54,35 +58,86 @@ tokenizer = ldm_stable.tokenizer
 # 
 
 # %%
+@lru_cache(maxsize=1024)
+def get_word_inds(prompt: str, word: Union[str, int]) -> Tuple[int, ...]:
+    # memoized ptp_utils.get_word_inds, each call re-tokenizes the whole prompt
+    return tuple(ptp_utils.get_word_inds(prompt, word, tokenizer).tolist())
+
+
+def maybe_compile(enabled: bool, **compile_kwargs):
+    # torch.compile only exists from torch 2.0 on, older versions simply run eagerly
+    def decorator(func):
+        if enabled and hasattr(torch, "compile"):
+            return torch.compile(func, **compile_kwargs)
+        return func
+    return decorator
+
+
+# the attention shapes differ per resolution but repeat every step, so each shape is compiled once.
+# no cuda graphs: they would keep a static copy of the inputs of every layer shape alive
+@maybe_compile(COMPILE_BLEND, dynamic=False)
+def _refine(attn_base, att_replace, mapper_flat, alphas):
+    # gather the mapped words of the source prompt, (h, p, b * n) -> (b, h, p, n), and blend.
+    # an index_select and a lerp when run eagerly, a single fused kernel with COMPILE_BLEND
+    attn_base_replace = attn_base.index_select(2, mapper_flat)
+    attn_base_replace = attn_base_replace.view(*attn_base.shape[:2], alphas.shape[0], -1).permute(2, 0, 1, 3)
+    return torch.lerp(att_replace, attn_base_replace, alphas)
+
+
 class LocalBlend:
+    __slots__ = ('alpha_layers', 'threshold', 'mask_interval', 'last_mask', 'last_mask_step')
 
-    def __call__(self, x_t, attention_store):
+    def __call__(self, x_t, attention_store, step: int):
+        if self.last_mask is not None and 0 < step - self.last_mask_step < self.mask_interval:
+            return x_t[:1] + self.last_mask * (x_t - x_t[:1])
         k = 1
+        batch_size = self.alpha_layers.shape[0]
         maps = attention_store["down_cross"][2:4] + attention_store["up_cross"][:3]
-        maps = [item.reshape(self.alpha_layers.shape[0], -1, 1, 16, 16, MAX_NUM_WORDS) for item in maps]
-        maps = torch.cat(maps, dim=1)
-        maps = (maps * self.alpha_layers).sum(-1).mean(1)
-        mask = nnf.max_pool2d(maps, (k * 2 + 1, k * 2 +1), (1, 1), padding=(k, k))
+        maps = [item.view(batch_size, -1, 16 ** 2, MAX_NUM_WORDS) for item in maps]
+        alpha_layers = self.alpha_layers
+        # weight the words and sum over heads in one contraction per layer, the maps are never concatenated
+        num_heads = sum(item.shape[1] for item in maps)
+        # accumulated in place into the first layer's result, sum() would allocate a new tensor for every layer
+        mask = torch.einsum('bhpk,bk->bp', maps[0], alpha_layers)
+        for item in maps[1:]:
+            mask.add_(torch.einsum('bhpk,bk->bp', item, alpha_layers))
+        mask = mask.div_(num_heads).view(batch_size, 1, 16, 16)
+        mask = nnf.max_pool2d(mask, (k * 2 + 1, k * 2 +1), (1, 1), padding=(k, k))
         mask = nnf.interpolate(mask, size=(x_t.shape[2:]))
-        mask = mask / mask.max(2, keepdims=True)[0].max(3, keepdims=True)[0]
-        mask = mask.gt(self.threshold)
-        mask = (mask[:1] + mask[1:]).float()
+        # clamped so a mask with no response to the words stays zero instead of turning into nan
+        mask = mask.div_(mask.amax(dim=(2, 3), keepdim=True).clamp_min_(1e-8))
+        mask = mask.gt_(self.threshold)
+        mask = torch.maximum(mask[:1], mask[1:])
+        self.last_mask, self.last_mask_step = mask, step
         x_t = x_t[:1] + mask * (x_t - x_t[:1])
         return x_t
+
+    def reset(self):
+        self.last_mask, self.last_mask_step = None, -1
        
-    def __init__(self, prompts: List[str], words: [List[List[str]]], threshold=.3):
-        alpha_layers = torch.zeros(len(prompts),  1, 1, 1, 1, MAX_NUM_WORDS)
+    def __init__(self, prompts: List[str], words: [List[List[str]]], threshold=.3, mask_interval: int = 1):
+        # mask_interval: recompute the mask every mask_interval steps and reuse it in between
+        # built on device in the dtype of the stored maps, 0/1 is exact in half precision
+        alpha_layers = torch.zeros(len(prompts), MAX_NUM_WORDS, dtype=torch.float16, device=device)
+        rows, cols = [], []
         for i, (prompt, words_) in enumerate(zip(prompts, words)):
             if type(words_) is str:
                 words_ = [words_]
             for word in words_:
-                ind = ptp_utils.get_word_inds(prompt, word, tokenizer)
-                alpha_layers[i, :, :, :, :, ind] = 1
-        self.alpha_layers = alpha_layers.to(device)
+                ind = get_word_inds(prompt, word)
+                rows += [i] * len(ind)
+                cols += ind
+        alpha_layers[rows, cols] = 1
+        self.alpha_layers = alpha_layers
         self.threshold = threshold
+        self.mask_interval = mask_interval
+        self.last_mask, self.last_mask_step = None, -1
 
 
 class AttentionControl(abc.ABC):
+    # controllers are called in every attention layer, slots keep their attribute lookups off __dict__.
+    # abc.ABC declares empty slots itself, so it does not bring a __dict__ back
+    __slots__ = ('cur_step', 'num_att_layers', 'cur_att_layer')
     
     def step_callback(self, x_t):
         return x_t
@@ -98,6 +153,25 @@ class AttentionControl(abc.ABC):
     def forward (self, attn, is_cross: bool, place_in_unet: str):
         raise NotImplementedError
 
+    def needs_weights(self, is_cross: bool, place_in_unet: str, num_pixels: int):
+        # layers for which this returns False run fused attention and only advance the layer counter,
+        # the unconditional pass of LOW_RESOURCE never reaches forward so it never needs them
+        return self.cur_att_layer >= self.num_uncond_att_layers
+
+    def get_cross_output(self, layer: int):
+        # a tensor returned here replaces the whole cross attention layer, the controller is not called for it
+        return None
+
+    def set_cross_output(self, layer: int, out):
+        return
+
+    def next_layer(self):
+        self.cur_att_layer += 1
+        if self.cur_att_layer == self.num_att_layers + self.num_uncond_att_layers:
+            self.cur_att_layer = 0
+            self.cur_step += 1
+            self.between_steps()
+
     def __call__(self, attn, is_cross: bool, place_in_unet: str):
         if self.cur_att_layer >= self.num_uncond_att_layers:
             if LOW_RESOURCE:
@@ -105,11 +179,7 @@ class AttentionControl(abc.ABC):
             else:
                 h = attn.shape[0]
                 attn[h // 2:] = self.forward(attn[h // 2:], is_cross, place_in_unet)
-        self.cur_att_layer += 1
-        if self.cur_att_layer == self.num_att_layers + self.num_uncond_att_layers:
-            self.cur_att_layer = 0
-            self.cur_step += 1
-            self.between_steps()
+        self.next_layer()
         return attn
     
     def reset(self):
@@ -122,35 +192,79 @@ class AttentionControl(abc.ABC):
         self.cur_att_layer = 0
 
 class EmptyControl(AttentionControl):
+    __slots__ = ()
+
+    def needs_weights(self, is_cross: bool, place_in_unet: str, num_pixels: int):
+        return False
     
     def forward (self, attn, is_cross: bool, place_in_unet: str):
         return attn
     
     
 class AttentionStore(AttentionControl):
+    __slots__ = ('step_store', 'attention_store', 'scratch_store', 'freeze_step', 'save_self', 'save_self_res', 'cross_cache')
 
     @staticmethod
     def get_empty_store():
         return {"down_cross": [], "mid_cross": [], "up_cross": [],
                 "down_self": [],  "mid_self": [],  "up_self": []}
 
+    def stores(self, is_cross: bool, num_pixels: int):
+        if num_pixels > 32 ** 2:  # avoid memory overhead
+            return False
+        return is_cross or (self.save_self and (self.save_self_res is None or num_pixels == self.save_self_res ** 2))
+
+    def needs_weights(self, is_cross: bool, place_in_unet: str, num_pixels: int):
+        return super(AttentionStore, self).needs_weights(is_cross, place_in_unet, num_pixels) and self.stores(is_cross, num_pixels)
+
     def forward(self, attn, is_cross: bool, place_in_unet: str):
         key = f"{place_in_unet}_{'cross' if is_cross else 'self'}"
-        if attn.shape[1] <= 32 ** 2:  # avoid memory overhead
-            self.step_store[key].append(attn)
+        if self.stores(is_cross, attn.shape[1]):
+            step_maps, scratch = self.step_store[key], self.scratch_store[key]
+            i = len(step_maps)
+            if i < len(scratch) and scratch[i].shape == attn.shape:
+                # same layer as in the previous step, reuse the buffer its map was summed from
+                step_maps.append(scratch[i].copy_(attn))
+            else:
+                # keep the stored maps in half precision, they are only summed and read back for blending/visualization.
+                # always a copy: with a half precision UNet a view would keep the whole batch's weights alive
+                step_maps.append(attn.detach().to(torch.float16, copy=True))
         return attn
 
+    def get_cross_output(self, layer: int):
+        if self.freeze_step is not None and self.cur_step >= self.freeze_step:
+            return self.cross_cache.get(layer)
+        return None
+
+    def set_cross_output(self, layer: int, out):
+        # the last layer of a step is reported after cur_step already moved on, hence <=
+        if self.freeze_step is not None and self.cur_step <= self.freeze_step:
+            self.cross_cache[layer] = out
+
     def between_steps(self):
         if len(self.attention_store) == 0:
             self.attention_store = self.step_store
+            self.scratch_store = self.get_empty_store()
         else:
             for key in self.attention_store:
-                for i in range(len(self.attention_store[key])):
-                    self.attention_store[key][i] += self.step_store[key][i]
+                # frozen cross attention layers are not called anymore and leave their step store empty
+                if len(self.step_store[key]) > 0:
+                    # one multi-tensor kernel per key instead of one add per stored map
+                    torch._foreach_add_(self.attention_store[key], self.step_store[key])
+            # summed in, the buffers are overwritten by the next step instead of being reallocated
+            self.scratch_store = self.step_store
         self.step_store = self.get_empty_store()
 
+    def get_num_stored_steps(self, key):
+        if self.freeze_step is not None and key.endswith("cross"):
+            return min(self.cur_step, self.freeze_step)
+        return self.cur_step
+
     def get_average_attention(self):
-        average_attention = {key: [item / self.cur_step for item in self.attention_store[key]] for key in self.attention_store}
+        average_attention = {key: [item.float() for item in self.attention_store[key]] for key in self.attention_store}
+        for key in average_attention:
+            if len(average_attention[key]) > 0:
+                torch._foreach_div_(average_attention[key], self.get_num_stored_steps(key))
         return average_attention
 
 
@@ -158,19 +272,43 @@ class AttentionStore(AttentionControl):
         super(AttentionStore, self).reset()
         self.step_store = self.get_empty_store()
         self.attention_store = {}
-
-    def __init__(self):
+        self.scratch_store = self.get_empty_store()
+        self.cross_cache = {}
+
+    def __init__(self, freeze_step: Optional[int] = None, save_self: bool = True, save_self_res: Optional[int] = None):
+        # freeze_step: if set, the cross attention outputs of step freeze_step - 1 are reused for all later steps,
+        # skipping the cross attention computation for the rest of the diffusion at the cost of an approximation.
+        # save_self / save_self_res: whether to store self attention maps at all, and if so only at this resolution
+        if freeze_step is not None and freeze_step < 1:
+            raise ValueError(f"freeze_step must be None or at least 1, got {freeze_step}")
         super(AttentionStore, self).__init__()
         self.step_store = self.get_empty_store()
         self.attention_store = {}
+        self.scratch_store = self.get_empty_store()
+        self.freeze_step = freeze_step
+        self.save_self = save_self
+        self.save_self_res = save_self_res
+        self.cross_cache = {}
 
         
 class AttentionControlEdit(AttentionStore, abc.ABC):
+    __slots__ = ('batch_size', 'cross_replace_alpha', 'cur_alpha_words', 'alpha_nonzero', 'num_self_replace', 'local_blend')
     
     def step_callback(self, x_t):
         if self.local_blend is not None:
-            x_t = self.local_blend(x_t, self.attention_store)
+            x_t = self.local_blend(x_t, self.attention_store, self.cur_step)
         return x_t
+
+    def between_steps(self):
+        super(AttentionControlEdit, self).between_steps()
+        # indexed once per step instead of in every cross attention layer
+        self.cur_alpha_words = self.cross_replace_alpha[self.cur_step]
+
+    def reset(self):
+        super(AttentionControlEdit, self).reset()
+        self.cur_alpha_words = self.cross_replace_alpha[self.cur_step]
+        if self.local_blend is not None:
+            self.local_blend.reset()
         
     def replace_self_attention(self, attn_base, att_replace):
         if att_replace.shape[2] <= 16 ** 2:
@@ -182,71 +320,98 @@ class AttentionControlEdit(AttentionStore, abc.ABC):
     def replace_cross_attention(self, attn_base, att_replace):
         raise NotImplementedError
     
+    def needs_weights(self, is_cross: bool, place_in_unet: str, num_pixels: int):
+        # cross attention is edited at every resolution while its alphas are nonzero, self attention only at 16x16
+        edits = self.edits(is_cross) and (is_cross or num_pixels <= 16 ** 2)
+        return AttentionControl.needs_weights(self, is_cross, place_in_unet, num_pixels) and (edits or self.stores(is_cross, num_pixels))
+
+    def edits(self, is_cross: bool):
+        # past cross_replace_steps the alphas are all zero and the blend would give back the target attention unchanged
+        if is_cross:
+            return self.alpha_nonzero[self.cur_step]
+        return self.num_self_replace[0] <= self.cur_step < self.num_self_replace[1]
+
     def forward(self, attn, is_cross: bool, place_in_unet: str):
-        super(AttentionControlEdit, self).forward(attn, is_cross, place_in_unet)
-        if is_cross or (self.num_self_replace[0] <= self.cur_step < self.num_self_replace[1]):
+        if self.edits(is_cross):
+            # edit through a view so the result lands in attn's own storage, no reshape back needed
             h = attn.shape[0] // (self.batch_size)
-            attn = attn.reshape(self.batch_size, h, *attn.shape[1:])
-            attn_base, attn_repalce = attn[0], attn[1:]
+            attn_view = attn.view(self.batch_size, h, *attn.shape[1:])
+            attn_base, attn_repalce = attn_view[0], attn_view[1:]
             if is_cross:
-                alpha_words = self.cross_replace_alpha[self.cur_step]
-                attn_repalce_new = self.replace_cross_attention(attn_base, attn_repalce) * alpha_words + (1 - alpha_words) * attn_repalce
-                attn[1:] = attn_repalce_new
+                # lerp(a, b, w) == b * w + (1 - w) * a in a single kernel
+                attn_repalce_new = torch.lerp(attn_repalce, self.replace_cross_attention(attn_base, attn_repalce), self.cur_alpha_words)
+                # slice assignment rather than copy_: a composed AttentionReweight returns an extra leading singleton dim
+                attn_view[1:] = attn_repalce_new
             else:
-                attn[1:] = self.replace_self_attention(attn_base, attn_repalce)
-            attn = attn.reshape(self.batch_size * h, *attn.shape[2:])
+                attn_view[1:] = self.replace_self_attention(attn_base, attn_repalce)
+        # stored after editing: the half precision copy no longer aliases attn, so in-place edits would not reach it
+        super(AttentionControlEdit, self).forward(attn, is_cross, place_in_unet)
         return attn
     
     def __init__(self, prompts, num_steps: int,
                  cross_replace_steps: Union[float, Tuple[float, float], Dict[str, Tuple[float, float]]],
                  self_replace_steps: Union[float, Tuple[float, float]],
-                 local_blend: Optional[LocalBlend]):
-        super(AttentionControlEdit, self).__init__()
+                 local_blend: Optional[LocalBlend], save_self: bool = False, save_self_res: Optional[int] = None):
+        # the edits (and LocalBlend) only read cross attention, set save_self to visualize self attention as well
+        super(AttentionControlEdit, self).__init__(save_self=save_self, save_self_res=save_self_res)
         self.batch_size = len(prompts)
-        self.cross_replace_alpha = ptp_utils.get_time_words_attention_alpha(prompts, num_steps, cross_replace_steps, tokenizer).to(device)
+        # kept in the attention dtype: torch.lerp does not promote its weight like the expression it replaced did
+        cross_replace_alpha = ptp_utils.get_time_words_attention_alpha(prompts, num_steps, cross_replace_steps, tokenizer)
+        self.cross_replace_alpha = cross_replace_alpha.to(device, ldm_stable.unet.dtype).contiguous()
+        self.cur_alpha_words = self.cross_replace_alpha[self.cur_step]
+        self.alpha_nonzero = self.cross_replace_alpha.flatten(1).any(1).tolist()
         if type(self_replace_steps) is float:
             self_replace_steps = 0, self_replace_steps
         self.num_self_replace = int(num_steps * self_replace_steps[0]), int(num_steps * self_replace_steps[1])
         self.local_blend = local_blend
 
 class AttentionReplace(AttentionControlEdit):
+    __slots__ = ('mapper',)
 
     def replace_cross_attention(self, attn_base, att_replace):
-        return torch.einsum('hpw,bwn->bhpn', attn_base, self.mapper)
+        # (1, h, p, w) @ (b, 1, w, n) -> (b, h, p, n), same as einsum('hpw,bwn->bhpn') as one batched gemm
+        return torch.matmul(attn_base.unsqueeze(0), self.mapper.unsqueeze(1))
       
     def __init__(self, prompts, num_steps: int, cross_replace_steps: float, self_replace_steps: float,
-                 local_blend: Optional[LocalBlend] = None):
-        super(AttentionReplace, self).__init__(prompts, num_steps, cross_replace_steps, self_replace_steps, local_blend)
-        self.mapper = seq_aligner.get_replacement_mapper(prompts, tokenizer).to(device)
+                 local_blend: Optional[LocalBlend] = None, save_self: bool = False, save_self_res: Optional[int] = None):
+        super(AttentionReplace, self).__init__(prompts, num_steps, cross_replace_steps, self_replace_steps, local_blend,
+                                               save_self, save_self_res)
+        self.mapper = seq_aligner.get_replacement_mapper(prompts, tokenizer).to(device, ldm_stable.unet.dtype)
         
 
 class AttentionRefine(AttentionControlEdit):
+    __slots__ = ('mapper', 'mapper_flat', 'alphas')
 
     def replace_cross_attention(self, attn_base, att_replace):
-        attn_base_replace = attn_base[:, :, self.mapper].permute(2, 0, 1, 3)
-        attn_replace = attn_base_replace * self.alphas + att_replace * (1 - self.alphas)
-        return attn_replace
+        return _refine(attn_base, att_replace, self.mapper_flat, self.alphas)
 
     def __init__(self, prompts, num_steps: int, cross_replace_steps: float, self_replace_steps: float,
-                 local_blend: Optional[LocalBlend] = None):
-        super(AttentionRefine, self).__init__(prompts, num_steps, cross_replace_steps, self_replace_steps, local_blend)
+                 local_blend: Optional[LocalBlend] = None, save_self: bool = False, save_self_res: Optional[int] = None):
+        super(AttentionRefine, self).__init__(prompts, num_steps, cross_replace_steps, self_replace_steps, local_blend,
+                                              save_self, save_self_res)
         self.mapper, alphas = seq_aligner.get_refinement_mapper(prompts, tokenizer)
-        self.mapper, alphas = self.mapper.to(device), alphas.to(device)
+        # lerp needs its weight in the attention dtype, unlike the promoting expression it replaced
+        self.mapper, alphas = self.mapper.to(device), alphas.to(device, ldm_stable.unet.dtype)
+        self.mapper_flat = self.mapper.reshape(-1)
         self.alphas = alphas.reshape(alphas.shape[0], 1, 1, alphas.shape[1])
 
 
 class AttentionReweight(AttentionControlEdit):
+    __slots__ = ('equalizer', 'prev_controller')
 
     def replace_cross_attention(self, attn_base, att_replace):
         if self.prev_controller is not None:
             attn_base = self.prev_controller.replace_cross_attention(attn_base, att_replace)
-        attn_replace = attn_base[None, :, :, :] * self.equalizer[:, None, None, :]
+        attn_replace = attn_base[None, :, :, :] * self.equalizer
         return attn_replace
 
     def __init__(self, prompts, num_steps: int, cross_replace_steps: float, self_replace_steps: float, equalizer,
-                local_blend: Optional[LocalBlend] = None, controller: Optional[AttentionControlEdit] = None):
-        super(AttentionReweight, self).__init__(prompts, num_steps, cross_replace_steps, self_replace_steps, local_blend)
-        self.equalizer = equalizer.to(device)
+                local_blend: Optional[LocalBlend] = None, controller: Optional[AttentionControlEdit] = None,
+                save_self: bool = False, save_self_res: Optional[int] = None):
+        super(AttentionReweight, self).__init__(prompts, num_steps, cross_replace_steps, self_replace_steps, local_blend,
+                                                save_self, save_self_res)
+        equalizer = equalizer.to(device, ldm_stable.unet.dtype)
+        self.equalizer = equalizer.reshape(equalizer.shape[0], 1, 1, equalizer.shape[1])
         self.prev_controller = controller
 
 
@@ -257,8 +422,8 @@ def get_equalizer(text: str, word_select: Union[int, Tuple[int, ...]], values: U
     equalizer = torch.ones(len(values), 77)
     values = torch.tensor(values, dtype=torch.float32)
     for word in word_select:
-        inds = ptp_utils.get_word_inds(text, word, tokenizer)
-        equalizer[:, inds] = values
+        inds = list(get_word_inds(text, word))
+        equalizer[:, inds] = values[:, None]
     return equalizer
 
 
@@ -274,6 +439,9 @@ def aggregate_attention(attention_store: AttentionStore, res: int, from_where: L
             if item.shape[1] == num_pixels:
                 cross_maps = item.reshape(len(prompts), -1, res, res, item.shape[-1])[select]
                 out.append(cross_maps)
+    if len(out) == 0:
+        raise ValueError(f"no {'cross' if is_cross else 'self'} attention maps of resolution {res} stored in {from_where}, "
+                         f"edit controllers only store self attention with save_self=True")
     out = torch.cat(out, dim=0)
     out = out.sum(0) / out.shape[0]
     return out.cpu()
@@ -283,22 +451,22 @@ def show_cross_attention(attention_store: AttentionStore, res: int, from_where:
     tokens = tokenizer.encode(prompts[select])
     decoder = tokenizer.decode
     attention_maps = aggregate_attention(attention_store, res, from_where, True, select)
-    images = []
-    for i in range(len(tokens)):
-        image = attention_maps[:, :, i]
-        image = 255 * image / image.max()
-        image = image.unsqueeze(-1).expand(*image.shape, 3)
-        image = image.numpy().astype(np.uint8)
-        image = np.array(Image.fromarray(image).resize((256, 256)))
-        image = ptp_utils.text_under_image(image, decoder(int(tokens[i])))
-        images.append(image)
+    # normalize and upsample all token maps in one batch, only the captions are drawn per token
+    maps = attention_maps[:, :, :len(tokens)].permute(2, 0, 1)
+    maps = 255 * maps / maps.amax(dim=(1, 2), keepdim=True).clamp_min(1e-8)
+    maps = nnf.interpolate(maps.unsqueeze(1), size=(256, 256), mode="bicubic", align_corners=False)
+    maps = maps.clamp(0, 255).to(torch.uint8).expand(-1, 3, -1, -1).permute(0, 2, 3, 1).numpy()
+    images = [ptp_utils.text_under_image(image, decoder(int(tokens[i]))) for i, image in enumerate(maps)]
     ptp_utils.view_images(np.stack(images, axis=0))
     
 
 def show_self_attention_comp(attention_store: AttentionStore, res: int, from_where: List[str],
                         max_com=10, select: int = 0):
-    attention_maps = aggregate_attention(attention_store, res, from_where, False, select).numpy().reshape((res ** 2, res ** 2))
-    u, s, vh = np.linalg.svd(attention_maps - np.mean(attention_maps, axis=1, keepdims=True))
+    attention_maps = aggregate_attention(attention_store, res, from_where, False, select).reshape((res ** 2, res ** 2))
+    # only the leading max_com components are shown, a randomized low rank svd is enough
+    centered = attention_maps - attention_maps.mean(dim=1, keepdim=True)
+    _, _, v = torch.svd_lowrank(centered, q=max_com + 6, niter=2)
+    vh = v[:, :max_com].T.numpy()
     images = []
     for i in range(max_com):
         image = vh[i].reshape(res, res)
@@ -182,8 +182,16 @@ def register_attention_control(model, controller):
         def forward(x, context=None, mask=None):
             batch_size, sequence_length, dim = x.shape
             h = self.heads
-            q = self.to_q(x)
             is_cross = context is not None
+            # only controllers that count their layers can cache cross attention outputs
+            layer = getattr(controller, "cur_att_layer", None) if is_cross else None
+            if layer is not None:
+                out = get_cross_output(layer)
+                if out is not None:
+                    # frozen cross attention output, the controller only has to count the layer
+                    next_layer()
+                    return out
+            q = self.to_q(x)
             context = context if is_cross else x
             k = self.to_k(context)
             v = self.to_v(context)
@@ -191,20 +199,34 @@ def register_attention_control(model, controller):
             k = self.reshape_heads_to_batch_dim(k)
             v = self.reshape_heads_to_batch_dim(v)
 
-            sim = torch.einsum("b i d, b j d -> b i j", q, k) * self.scale
-
-            if mask is not None:
-                mask = mask.reshape(batch_size, -1)
-                max_neg_value = -torch.finfo(sim.dtype).max
-                mask = mask[:, None, :].repeat(h, 1, 1)
-                sim.masked_fill_(~mask, max_neg_value)
-
-            # attention, what we cannot get enough of
-            attn = sim.softmax(dim=-1)
-            attn = controller(attn, is_cross, place_in_unet)
-            out = torch.einsum("b i j, b j d -> b i d", attn, v)
+            if mask is None and hasattr(torch.nn.functional, "scaled_dot_product_attention") \
+                    and not needs_weights(is_cross, place_in_unet, sequence_length):
+                # the controller neither reads nor edits this layer, so the attention weights are never materialized.
+                # the fused kernels only take (batch, heads, seq, dim), the math fallback used for 3-D input builds them
+                dim_head = q.shape[-1]
+                q, k, v = (item.view(batch_size, h, -1, dim_head) for item in (q, k, v))
+                out = torch.nn.functional.scaled_dot_product_attention(q, k, v)
+                # reshape rather than view: the fused kernels may return a transposed layout
+                out = out.reshape(batch_size * h, -1, dim_head)
+                next_layer()
+            else:
+                sim = torch.einsum("b i d, b j d -> b i j", q, k) * self.scale
+
+                if mask is not None:
+                    mask = mask.reshape(batch_size, -1)
+                    max_neg_value = -torch.finfo(sim.dtype).max
+                    mask = mask[:, None, :].repeat(h, 1, 1)
+                    sim.masked_fill_(~mask, max_neg_value)
+
+                # attention, what we cannot get enough of
+                attn = sim.softmax(dim=-1)
+                attn = controller(attn, is_cross, place_in_unet)
+                out = torch.einsum("b i j, b j d -> b i d", attn, v)
             out = self.reshape_batch_dim_to_heads(out)
-            return to_out(out)
+            out = to_out(out)
+            if layer is not None:
+                set_cross_output(layer, out)
+            return out
 
         return forward
 
@@ -213,11 +235,19 @@ def register_attention_control(model, controller):
         def __call__(self, *args):
             return args[0]
 
+        def needs_weights(self, *args):
+            return False
+
         def __init__(self):
             self.num_att_layers = 0
 
     if controller is None:
         controller = DummyController()
+    # optional controller hooks, controllers that only implement __call__ keep working unchanged
+    get_cross_output = getattr(controller, "get_cross_output", lambda layer: None)
+    set_cross_output = getattr(controller, "set_cross_output", lambda layer, out: None)
+    next_layer = getattr(controller, "next_layer", lambda: None)
+    needs_weights = getattr(controller, "needs_weights", lambda is_cross, place_in_unet, num_pixels: True)
 
     def register_recr(net_, count, place_in_unet):
         if net_.__class__.__name__ == 'CrossAttention':
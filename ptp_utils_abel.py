@@ -107,8 +107,9 @@ def text2image_ldm(
     guidance_scale: Optional[float] = 7.,
     generator: Optional[torch.Generator] = None,
     latent: Optional[torch.FloatTensor] = None,
+    compiled_unet: bool = False,
 ):
-    register_attention_control(model, controller)
+    register_attention_control(model, controller, compiled_unet)
     height = width = 256
     batch_size = len(prompt)
     
@@ -176,7 +177,17 @@ def text2image_ldm_stable(
     return image, latent
 
 
-def register_attention_control(model, controller):
+def run_eagerly(func):
+    # controllers keep Python state (layer/step counters, stored maps) that torch.compile would otherwise
+    # specialize on and recompile for at every step
+    compiler = getattr(torch, "compiler", None) or getattr(torch, "_dynamo", None)
+    if compiler is not None and hasattr(compiler, "disable"):
+        return compiler.disable(func)
+    return func
+
+
+def register_attention_control(model, controller, compiled_unet: bool = False):
+    # compiled_unet: the UNet forward runs under torch.compile, the controller calls are then kept out of the graph
     def ca_forward(self, place_in_unet):
         to_out = self.to_out
         if type(to_out) is torch.nn.modules.container.ModuleList:
@@ -196,18 +207,29 @@ def register_attention_control(model, controller):
             k = self.reshape_heads_to_batch_dim(k)
             v = self.reshape_heads_to_batch_dim(v)
 
-            sim = torch.einsum("b i d, b j d -> b i j", q, k) * self.scale
-
-            if mask is not None:
-                mask = mask.reshape(batch_size, -1)
-                max_neg_value = -torch.finfo(sim.dtype).max
-                mask = mask[:, None, :].repeat(h, 1, 1)
-                sim.masked_fill_(~mask, max_neg_value)
-
-            # attention, what we cannot get enough of
-            attn = sim.softmax(dim=-1)
-            attn = controller(attn, is_cross, place_in_unet)
-            out = torch.einsum("b i j, b j d -> b i d", attn, v)
+            if mask is None and hasattr(torch.nn.functional, "scaled_dot_product_attention") \
+                    and not needs_weights(is_cross, place_in_unet, sequence_length):
+                # the controller neither reads nor edits this layer, so the attention weights are never materialized.
+                # the fused kernels only take (batch, heads, seq, dim), the math fallback used for 3-D input builds them
+                dim_head = q.shape[-1]
+                q, k, v = (item.view(batch_size, h, -1, dim_head) for item in (q, k, v))
+                out = torch.nn.functional.scaled_dot_product_attention(q, k, v)
+                # reshape rather than view: the fused kernels may return a transposed layout
+                out = out.reshape(batch_size * h, -1, dim_head)
+                next_layer()
+            else:
+                sim = torch.einsum("b i d, b j d -> b i j", q, k) * self.scale
+
+                if mask is not None:
+                    mask = mask.reshape(batch_size, -1)
+                    max_neg_value = -torch.finfo(sim.dtype).max
+                    mask = mask[:, None, :].repeat(h, 1, 1)
+                    sim.masked_fill_(~mask, max_neg_value)
+
+                # attention, what we cannot get enough of
+                attn = sim.softmax(dim=-1)
+                attn = call_controller(attn, is_cross, place_in_unet)
+                out = torch.einsum("b i j, b j d -> b i d", attn, v)
             out = self.reshape_batch_dim_to_heads(out)
             return to_out(out)
 
@@ -218,11 +240,23 @@ def register_attention_control(model, controller):
         def __call__(self, *args):
             return args[0]
 
+        def needs_weights(self, *args):
+            return False
+
+        def next_layer(self):
+            return
+
         def __init__(self):
             self.num_att_layers = 0
 
     if controller is None:
         controller = DummyController()
+    # optional controller hooks, controllers that only implement __call__ keep the einsum/softmax path
+    needs_weights = getattr(controller, "needs_weights", lambda is_cross, place_in_unet, num_pixels: True)
+    next_layer = getattr(controller, "next_layer", lambda: None)
+    call_controller = controller.__call__
+    if compiled_unet:
+        call_controller, next_layer = run_eagerly(call_controller), run_eagerly(next_layer)
 
     # Update the CrossAttention layers' forward function with ca_forward
     def register_recr(net_, count, place_in_unet):